@@ -8,7 +8,7 @@
 # What it does:
 #   1. Rsyncs tts-server/ to ~/nanoclaw-tts/ on the target
 #   2. Installs uv + deps
-#   3. Installs ffmpeg if missing
+#   3. Installs ffmpeg, sox and libsndfile (Opus/Ogg) if missing
 #   4. Sets up launchd (macOS) or systemd (Linux) service
 #   5. Starts/restarts the service
 #
@@ -41,7 +41,8 @@ echo "==> Detecting platform..."
 OS="$(uname -s)"
 echo "    OS: ${OS}"
 
-# Install system dependencies (ffmpeg + sox)
+# Install system dependencies (ffmpeg + sox, plus libsndfile with opus/libogg
+# for in-process Opus encoding when the soundfile wheel doesn't bundle it)
 if [[ "$OS" == "Darwin" ]]; then
   for pkg in ffmpeg sox; do
     if ! command -v "$pkg" &>/dev/null; then
@@ -49,10 +50,19 @@ if [[ "$OS" == "Darwin" ]]; then
       brew install "$pkg"
     fi
   done
+  for pkg in libsndfile opus libogg; do
+    if ! brew list "$pkg" &>/dev/null; then
+      echo "==> Installing ${pkg}..."
+      brew install "$pkg"
+    fi
+  done
 else
   MISSING=()
   command -v ffmpeg &>/dev/null || MISSING+=(ffmpeg)
   command -v sox &>/dev/null || MISSING+=(sox)
+  for pkg in libsndfile1 libopus0 libogg0; do
+    dpkg -s "$pkg" &>/dev/null || MISSING+=("$pkg")
+  done
   if [ ${#MISSING[@]} -gt 0 ]; then
     echo "==> Installing ${MISSING[*]}..."
     sudo apt-get update -qq && sudo apt-get install -y -qq "${MISSING[@]}"
@@ -3,32 +3,41 @@ Qwen3-TTS Server — MLX inference on Apple Silicon for voice synthesis.
 
 Loads VoiceDesign (natural language voice descriptions), CustomVoice
 (9 preset speakers), and optionally a Base model for voice cloning
-via mlx-audio. Returns OGG/Opus audio.
+via mlx-audio. Streams OGG/Opus audio as it is generated.
 
 Run locally:
     python server.py
 
 Run with uvicorn:
-    uvicorn server:app --host 0.0.0.0 --port 8787
+    uvicorn server:app --host 0.0.0.0 --port 8787 --loop uvloop --http httptools --no-access-log
 
 Environment variables:
     TTS_API_KEY       — Required. Bearer token for auth.
     TTS_PORT          — Server port (default: 8787)
     TTS_HOST          — Server bind address (default: 0.0.0.0)
     TTS_CLONE_MODEL   — Model ID for voice cloning (default: 0.6B-Base)
+    TTS_DTYPE         — Weight dtype, bf16 or fp16 (default: bf16)
 """
 
+import asyncio
 import base64
+import binascii
+import functools
+import hashlib
+import io
 import os
-import subprocess
 import tempfile
+import threading
 import time
+from collections import Counter, OrderedDict
+from collections.abc import AsyncIterator, Callable
 from contextlib import asynccontextmanager
 
 import mlx.core as mx
 import numpy as np
+import soundfile as sf
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 
 # ---------------------------------------------------------------------------
@@ -46,6 +55,25 @@ TTS_CLONE_MODEL = os.environ.get(
     "mlx-community/Qwen3-TTS-12Hz-0.6B-Base-bf16",
 )
 
+# Checkpoints ship as bf16. TTS_DTYPE=fp16 casts them after load, as Metal's
+# fp16 kernels are faster on M-series GPUs; it stays opt-in until fp16 output
+# has been checked against bf16 by ear on real hardware.
+MODEL_DTYPES = {"fp16": mx.float16, "bf16": mx.bfloat16}
+TTS_DTYPE = os.environ.get("TTS_DTYPE", "bf16")
+if TTS_DTYPE not in MODEL_DTYPES:
+    TTS_DTYPE = "bf16"
+
+# Reference audio for voice cloning is capped before base64 decoding, and
+# staged on tmpfs where available so mlx-audio reads it from RAM.
+MAX_REF_AUDIO_BYTES = 10 * 1024 * 1024
+REF_AUDIO_TMPDIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+REF_AUDIO_CACHE_SIZE = 64
+
+# Seconds of audio mlx-audio decodes per streamed chunk. Smaller chunks reach
+# the client sooner but re-decode more codec context per chunk.
+STREAMING_INTERVAL = 1.0
+STREAM_KWARGS = dict(stream=True, streaming_interval=STREAMING_INTERVAL)
+
 VALID_SPEAKERS = {
     "Vivian", "Serena", "Uncle_Fu", "Dylan",
     "Eric", "Ryan", "Aiden", "Ono_Anna", "Sohee",
@@ -65,43 +93,216 @@ custom_voice_model = None
 voice_clone_model = None
 start_time = 0.0
 
+# Single-worker queue in front of the models. MLX shares one GPU context, so
+# requests are serialized here instead of contending inside the event loop.
+model_queue: asyncio.Queue | None = None
+
+
+def load_tts_model(model_id: str):
+    """Load an mlx-audio model, cast it to TTS_DTYPE and materialize weights.
+
+    Only bf16 parameters are cast; anything the checkpoint keeps in float32
+    stays there. MLX is lazy, so without the eval the first request would pay for
+    pulling the weights into unified memory.
+    """
+    from mlx_audio.tts.utils import load_model
+
+    model = load_model(model_id)
+    model.set_dtype(MODEL_DTYPES[TTS_DTYPE], predicate=lambda d: d == mx.bfloat16)
+    mx.eval(model.parameters())
+    return model
+
+
+def warm_up_models():
+    """Run a short streamed generation through each startup model to prime kernels.
+
+    Requests always stream, so warm-up does too. 16 tokens covers one full
+    STREAMING_INTERVAL chunk plus the trailing partial one.
+    """
+    t0 = time.perf_counter()
+    list(voice_design_model.generate_voice_design(
+        text="hi", language="English", instruct="warm", max_tokens=16, **STREAM_KWARGS,
+    ))
+    list(custom_voice_model.generate_custom_voice(
+        text="hi", language="English", speaker="Vivian", instruct="", max_tokens=16,
+        **STREAM_KWARGS,
+    ))
+    print(f"Warm-up done in {time.perf_counter() - t0:.2f}s")
+
 
 def get_clone_model():
     """Lazy-load the Base model for voice cloning on first use."""
     global voice_clone_model
     if voice_clone_model is None:
-        from mlx_audio.tts.utils import load_model
-
         print(f"Loading VoiceClone model: {TTS_CLONE_MODEL}...")
-        voice_clone_model = load_model(TTS_CLONE_MODEL)
+        voice_clone_model = load_tts_model(TTS_CLONE_MODEL)
         print("VoiceClone model loaded.")
     return voice_clone_model
 
 
+# Staged reference files keyed by a hash of their base64 payload, so a group
+# reusing the same voice skips the decode and write on every utterance.
+ref_audio_cache: OrderedDict[str, str] = OrderedDict()
+# Queued or running jobs per staged path. Evicted files stay on disk until
+# the last job using them has finished.
+ref_audio_in_use: Counter[str] = Counter()
+
+
+def stage_ref_audio(ref_audio_base64: str) -> str:
+    """Return a path to the decoded reference audio, reusing cached files.
+
+    The payload is encoded to ASCII once and that bytes object is used for
+    both hashing and decoding. Malformed input raises UnicodeEncodeError or
+    binascii.Error before anything is written. Each returned path holds a
+    reference until release_ref_audio is called for it.
+    """
+    payload = ref_audio_base64.encode("ascii")
+    key = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    path = ref_audio_cache.get(key)
+    if path is not None and os.path.exists(path):
+        ref_audio_cache.move_to_end(key)
+        ref_audio_in_use[path] += 1
+        return path
+
+    audio_bytes = base64.b64decode(payload, validate=True)
+    fd, path = tempfile.mkstemp(dir=REF_AUDIO_TMPDIR, prefix="ref-", suffix=".wav")
+    with os.fdopen(fd, "wb") as f:
+        f.write(audio_bytes)
+    ref_audio_cache[key] = path
+    ref_audio_in_use[path] += 1
+
+    while len(ref_audio_cache) > REF_AUDIO_CACHE_SIZE:
+        _, evicted = ref_audio_cache.popitem(last=False)
+        if not ref_audio_in_use[evicted]:
+            clear_ref_audio(evicted)
+    return path
+
+
+def release_ref_audio(path: str):
+    """Drop a job's reference, unlinking the file if it was already evicted."""
+    ref_audio_in_use[path] -= 1
+    if ref_audio_in_use[path] <= 0:
+        del ref_audio_in_use[path]
+        if path not in ref_audio_cache.values():
+            clear_ref_audio(path)
+
+
+def clear_ref_audio(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def run_model(mode: str, kwargs: dict, emit: Callable, cancelled: threading.Event):
+    """Run one blocking generate call, emitting (int16 PCM, sample rate) per chunk.
+
+    Streaming mode makes mlx-audio decode and yield audio every
+    STREAMING_INTERVAL seconds. Voice clones with ref_text take mlx-audio's
+    ICL path, which ignores stream and yields the utterance in one piece.
+    Generation stops at the next chunk once the request is cancelled.
+    """
+    if cancelled.is_set():
+        return
+    if mode == "voice_design":
+        results = voice_design_model.generate_voice_design(**kwargs, **STREAM_KWARGS)
+    elif mode == "voice_clone":
+        results = get_clone_model().generate(**kwargs, **STREAM_KWARGS)
+    else:
+        results = custom_voice_model.generate_custom_voice(**kwargs, **STREAM_KWARGS)
+
+    for result in results:
+        if cancelled.is_set():
+            break
+        # Quantize on the MLX side, then view the result without another copy
+        audio = result.audio.astype(mx.float32)
+        pcm16 = mx.clip(audio * 32768, -32768, 32767).astype(mx.int16)
+        mx.eval(pcm16)
+        emit((np.asarray(pcm16), result.sample_rate))
+
+
+def run_job(mode: str, kwargs: dict, emit: Callable, cancelled: threading.Event):
+    """Run one job on the calling thread, ending its stream with None or the error."""
+    try:
+        run_model(mode, kwargs, emit, cancelled)
+    except Exception as e:
+        emit(e)
+    else:
+        emit(None)
+
+
+async def server_loop(queue: asyncio.Queue):
+    """Run queued jobs one at a time, in arrival order."""
+    loop = asyncio.get_running_loop()
+    while True:
+        mode, kwargs, chunks, cancelled = await queue.get()
+        # Chunks are handed back to the request's queue from the worker thread
+        emit = functools.partial(loop.call_soon_threadsafe, chunks.put_nowait)
+        try:
+            await asyncio.to_thread(run_job, mode, kwargs, emit, cancelled)
+        finally:
+            if "ref_audio" in kwargs:
+                release_ref_audio(kwargs["ref_audio"])
+            queue.task_done()
+
+
+async def generate(mode: str, kwargs: dict) -> AsyncIterator[tuple[np.ndarray, int]]:
+    """Enqueue a generate job and yield its audio chunks as the worker emits them.
+
+    Closing the generator early, e.g. when the client disconnects, cancels
+    the job so the worker moves on to the next request.
+    """
+    chunks: asyncio.Queue = asyncio.Queue()
+    cancelled = threading.Event()
+    await model_queue.put((mode, kwargs, chunks, cancelled))
+    try:
+        while True:
+            item = await chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global voice_design_model, custom_voice_model, start_time
-    from mlx_audio.tts.utils import load_model
+    global voice_design_model, custom_voice_model, start_time, model_queue
 
     print(f"Device: {DEVICE_NAME}")
+    print(f"Dtype: {TTS_DTYPE}")
     print(f"Auth: {'enabled' if API_KEY else 'DISABLED (no TTS_API_KEY set)'}")
 
     print("Loading VoiceDesign model...")
-    voice_design_model = load_model(
+    voice_design_model = load_tts_model(
         "mlx-community/Qwen3-TTS-12Hz-1.7B-VoiceDesign-bf16"
     )
 
     print("Loading CustomVoice model...")
-    custom_voice_model = load_model(
+    custom_voice_model = load_tts_model(
         "mlx-community/Qwen3-TTS-12Hz-1.7B-CustomVoice-bf16"
     )
 
+    print("Warming up models...")
+    warm_up_models()
+
+    if OPUS_INPROCESS and not opus_streams_early(custom_voice_model.sample_rate):
+        print("Warning: libsndfile ignores OGG_PAGE_LATENCY_MS; audio will lag ~1 s per chunk")
+
+    model_queue = asyncio.Queue()
+    worker = asyncio.create_task(server_loop(model_queue))
+
     start_time = time.time()
     print("Models loaded. Server ready.")
 
     yield
 
     print("Shutting down.")
+    worker.cancel()
+    for path in set(ref_audio_cache.values()) | set(ref_audio_in_use):
+        clear_ref_audio(path)
 
 
 app = FastAPI(title="Qwen3-TTS Server", lifespan=lifespan)
@@ -136,6 +337,157 @@ class SynthesizeRequest(BaseModel):
     ref_text: str = ""
 
 
+# ---------------------------------------------------------------------------
+# Audio encoding
+# ---------------------------------------------------------------------------
+
+
+# Rates libopus accepts natively; anything else goes through ffmpeg to resample
+OPUS_SAMPLE_RATES = {8000, 12000, 16000, 24000, 48000}
+OPUS_BITRATE = 64000
+
+# libsndfile (bundled with the soundfile wheels) encodes Opus in-process. Builds
+# without Opus support fall back to piping through ffmpeg.
+OPUS_INPROCESS = "OPUS" in sf.available_subtypes("OGG")
+
+# libsndfile maps compression_level 0.0-1.0 linearly onto 256-6 kb/s for Opus
+OPUS_COMPRESSION_LEVEL = (256000 - OPUS_BITRATE) / (256000 - 6000)
+
+# libsndfile otherwise holds Ogg pages until ~1 s of audio has built up, so a
+# one-second model chunk would produce no audio until the next one arrived.
+SFC_SET_OGG_PAGE_LATENCY_MS = 0x1302
+OGG_PAGE_LATENCY_MS = 100.0
+
+
+class _PageSink:
+    """Write-only file object that hands back what libsndfile has written."""
+
+    def __init__(self):
+        self._chunks: list[bytes] = []
+        self._pos = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        # Ogg output is written front to back; libsndfile only probes the position
+        target = offset if whence == io.SEEK_SET else self._pos + offset
+        if target != self._pos:
+            raise io.UnsupportedOperation("seek")
+        return self._pos
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+class OggOpusStreamEncoder:
+    """Incremental OGG/Opus encoder backed by libsndfile via soundfile.
+
+    Each write returns the Ogg pages completed so far, so audio can be sent
+    while the model is still generating.
+    """
+
+    def __init__(self, sr: int):
+        self._sink = _PageSink()
+        self._file = sf.SoundFile(
+            self._sink, "w",
+            samplerate=sr,
+            channels=1,
+            format="OGG",
+            subtype="OPUS",
+            compression_level=OPUS_COMPRESSION_LEVEL,
+        )
+        latency = sf._ffi.new("double*", OGG_PAGE_LATENCY_MS)
+        sf._snd.sf_command(
+            self._file._file, SFC_SET_OGG_PAGE_LATENCY_MS,
+            latency, sf._ffi.sizeof("double"),
+        )
+
+    def write(self, pcm_np: np.ndarray) -> bytes:
+        self._file.write(pcm_np)
+        return self._sink.drain()
+
+    def close(self) -> bytes:
+        self._file.close()
+        return self._sink.drain()
+
+
+def opus_streams_early(sr: int) -> bool:
+    """Check that a first write returns audio pages, not just the Ogg headers.
+
+    OpusHead and OpusTags take a page each, so a third page means libsndfile
+    honoured the page latency. Older builds silently ignore the command.
+    """
+    encoder = OggOpusStreamEncoder(sr)
+    try:
+        data = encoder.write(np.zeros(sr // 2, dtype=np.int16))
+    finally:
+        encoder.close()
+    return data.count(b"OggS") > 2
+
+
+async def encode_opus_ffmpeg(pcm16: bytes | memoryview, sr: int) -> bytes:
+    """Encode mono int16 PCM to OGG/Opus by piping it into ffmpeg."""
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-y",
+        "-f", "s16le",
+        "-ar", str(sr),
+        "-ac", "1",
+        "-i", "pipe:0",
+        "-c:a", "libopus",
+        "-b:a", str(OPUS_BITRATE),
+        "-f", "ogg",
+        "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await proc.communicate(pcm16)
+    if proc.returncode != 0:
+        raise HTTPException(
+            status_code=500,
+            detail=f"ffmpeg conversion failed: {stderr.decode()[:500]}",
+        )
+    return stdout
+
+
+async def stream_ogg_opus(
+    encoder: OggOpusStreamEncoder,
+    head: bytes,
+    rest: AsyncIterator[tuple[np.ndarray, int]],
+) -> AsyncIterator[bytes]:
+    """Encode the remaining PCM chunks to OGG/Opus as they arrive from the model.
+
+    The response is already committed as a 200 at this point, so a failure
+    is logged and re-raised to abort the connection rather than end the
+    body cleanly with truncated audio. If the client goes away, closing
+    rest tells the model worker to stop generating.
+    """
+    try:
+        if head:
+            yield head
+        async for pcm_np, _ in rest:
+            data = await asyncio.to_thread(encoder.write, pcm_np)
+            if data:
+                yield data
+        yield await asyncio.to_thread(encoder.close)
+    except Exception as e:
+        print(f"Synthesis failed mid-stream, aborting response: {e}")
+        raise
+    finally:
+        # Closing generate() only sets its cancel event, so nothing here
+        # suspends even when the response task is being cancelled
+        await rest.aclose()
+        encoder.close()
+
+
 # ---------------------------------------------------------------------------
 # Endpoints
 # ---------------------------------------------------------------------------
@@ -146,7 +498,7 @@ async def health():
     return {
         "status": "ok",
         "device": DEVICE_NAME,
-        "dtype": "bfloat16",
+        "dtype": "float16" if TTS_DTYPE == "fp16" else "bfloat16",
         "models_loaded": voice_design_model is not None and custom_voice_model is not None,
         "voice_clone_model_loaded": voice_clone_model is not None,
         "clone_model_id": TTS_CLONE_MODEL,
@@ -160,8 +512,6 @@ async def health():
 async def synthesize(req: SynthesizeRequest, request: Request):
     verify_auth(request)
 
-    import soundfile as sf
-
     # Validate inputs
     language = req.language if req.language in VALID_LANGUAGES else "English"
     text = req.text[:2000] if len(req.text) > 2000 else req.text
@@ -169,77 +519,83 @@ async def synthesize(req: SynthesizeRequest, request: Request):
     if not text.strip():
         raise HTTPException(status_code=400, detail="Text is empty")
 
-    # Generate audio via MLX
+    # Build the generate call for the model worker
     if req.mode == "voice_design":
         description = req.voice_description or "A warm, friendly voice"
-        results = list(voice_design_model.generate_voice_design(
+        mode = "voice_design"
+        generate_kwargs = dict(
             text=text,
             language=language,
             instruct=description,
             max_tokens=2400,
-        ))
+        )
     elif req.mode == "voice_clone":
-        clone_model = get_clone_model()
         if not req.ref_audio_base64:
             raise HTTPException(
                 status_code=400,
                 detail="voice_clone mode requires ref_audio_base64",
             )
 
-        # Decode base64 reference audio to temp WAV
-        audio_bytes = base64.b64decode(req.ref_audio_base64)
-        ref_tmp = tempfile.NamedTemporaryFile(suffix=".wav", delete=False)
+        # Reject oversized payloads before decoding (base64 is 4 chars per 3 bytes)
+        if (len(req.ref_audio_base64) * 3) // 4 > MAX_REF_AUDIO_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"ref_audio exceeds {MAX_REF_AUDIO_BYTES} bytes",
+            )
+
+        # mlx-audio loads (and resamples) reference audio from a path
         try:
-            ref_tmp.write(audio_bytes)
-            ref_tmp.close()
-
-            generate_kwargs = dict(
-                text=text,
-                ref_audio=ref_tmp.name,
-                language=language,
-                max_new_tokens=2400,
+            ref_audio_path = stage_ref_audio(req.ref_audio_base64)
+        except (UnicodeEncodeError, binascii.Error):
+            raise HTTPException(
+                status_code=400,
+                detail="ref_audio_base64 is not valid base64",
             )
-            if req.ref_text.strip():
-                generate_kwargs["ref_text"] = req.ref_text
-            else:
-                generate_kwargs["x_vector_only_mode"] = True
 
-            results = list(clone_model.generate(**generate_kwargs))
-        finally:
-            os.unlink(ref_tmp.name)
+        generate_kwargs = dict(
+            text=text,
+            ref_audio=ref_audio_path,
+            language=language,
+            max_new_tokens=2400,
+        )
+        if req.ref_text.strip():
+            generate_kwargs["ref_text"] = req.ref_text
+        else:
+            generate_kwargs["x_vector_only_mode"] = True
+        mode = "voice_clone"
     else:
         speaker = req.speaker if req.speaker in VALID_SPEAKERS else "Vivian"
-        results = list(custom_voice_model.generate_custom_voice(
+        mode = "custom_voice"
+        generate_kwargs = dict(
             text=text,
             language=language,
             speaker=speaker,
             instruct=req.instruct or "",
             max_tokens=2400,
-        ))
-
-    audio_np = np.array(results[0].audio.astype(mx.float32))
-    sr = results[0].sample_rate
-
-    # WAV → OGG/Opus via ffmpeg
-    with tempfile.NamedTemporaryFile(suffix=".wav", delete=True) as wav_f:
-        sf.write(wav_f.name, audio_np, sr)
-        result = subprocess.run(
-            [
-                "ffmpeg", "-y",
-                "-i", wav_f.name,
-                "-c:a", "libopus",
-                "-b:a", "64k",
-                "-f", "ogg",
-                "pipe:1",
-            ],
-            capture_output=True,
         )
-        if result.returncode != 0:
-            raise HTTPException(
-                status_code=500,
-                detail=f"ffmpeg conversion failed: {result.stderr.decode()[:500]}",
-            )
-        return Response(content=result.stdout, media_type="audio/ogg")
+
+    # Wait for the first chunk and encode it before committing to a 200, so
+    # model or encoder errors up to this point still return a 500
+    chunks = generate(mode, generate_kwargs)
+    pcm_np, sr = await anext(chunks)
+
+    encoder = None
+    if OPUS_INPROCESS and sr in OPUS_SAMPLE_RATES:
+        try:
+            encoder = OggOpusStreamEncoder(sr)
+            head = await asyncio.to_thread(encoder.write, pcm_np)
+        except sf.SoundFileError as e:
+            print(f"In-process Opus encoding failed, falling back to ffmpeg: {e}")
+            encoder = None
+
+    if encoder is None:
+        parts = [pcm_np] + [pcm async for pcm, _ in chunks]
+        ogg = await encode_opus_ffmpeg(memoryview(np.concatenate(parts)).cast("B"), sr)
+        return Response(content=ogg, media_type="audio/ogg")
+
+    return StreamingResponse(
+        stream_ogg_opus(encoder, head, chunks), media_type="audio/ogg",
+    )
 
 
 # ---------------------------------------------------------------------------
@@ -249,4 +605,13 @@ async def synthesize(req: SynthesizeRequest, request: Request):
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host=HOST, port=PORT)
+    # Single worker on purpose: extra workers would each load the models.
+    # uvloop/httptools come with uvicorn[standard].
+    uvicorn.run(
+        app,
+        host=HOST,
+        port=PORT,
+        loop="uvloop",
+        http="httptools",
+        access_log=False,
+    )